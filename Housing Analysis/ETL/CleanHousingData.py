@@ -1,13 +1,19 @@
 import datetime
 import logging
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import googlemaps
+import pandas as pd
 
-from common import execute_query, execute_update_query, upload_to_table
+from common import execute_query, execute_update_query, upload_to_table, upsert_dataframe
 
 _max_price = 10000
 _max_surface = 700
+_geocode_workers = 8
+_geocode_ttl_days = 365
+_geocode_negative_ttl_days = 30
 
 logging.basicConfig(level=logging.INFO)
 
@@ -59,49 +65,125 @@ def filter_df(df):
     return df
 
 
-def add_geo_info(df):
+def normalize_address(address):
+    if not isinstance(address, str):
+        return None
+    address = unicodedata.normalize("NFKC", address)
+    return " ".join(address.lower().replace(" ,", ",").split())
+
+
+def create_geocode_cache_table():
+    execute_update_query("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            address TEXT PRIMARY KEY,
+            formatted_address TEXT,
+            latitude DOUBLE PRECISION,
+            longitude DOUBLE PRECISION,
+            found BOOLEAN NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        )
+    """)
+
+
+def read_geocode_cache(addresses):
+    # Addresses that could not be geocoded are cached too, with a shorter TTL
+    q = f"""
+    SELECT address
+        , formatted_address
+        , latitude
+        , longitude
+    FROM geocode_cache
+    WHERE address = ANY(%s)
+        AND updated_at > now() - CASE WHEN found THEN INTERVAL '{_geocode_ttl_days} days'
+                                      ELSE INTERVAL '{_geocode_negative_ttl_days} days' END
+    """
+    df = execute_query(q, params=(list(addresses),))
+
+    return {row["address"]: row for row in df.to_dict("records")}
+
+
+def geocode_addresses(addresses, workers=_geocode_workers):
     ssm = boto3.client("ssm", region_name="eu-west-1")
     maps_key = ssm.get_parameter(Name="GOOGLE_MAPS_GEOCODING_API_KEY", WithDecryption=True)
     maps_key = maps_key["Parameter"]["Value"]
-
-    # WARNING!! Limit to 40k request monthly.
-    logging.info("Adding geographic info")
     gmaps = googlemaps.Client(key=maps_key)
 
-    def apply_geoinfo(x):
-        address = x["full_street_city"]
-        geocode_result = gmaps.geocode(address)
+    def geocode(item):
+        key, address = item
+        try:
+            geocode_result = gmaps.geocode(address)
+        except Exception as e:
+            logging.warning(f"Geocoding failed for {address}: {e}")
+            return None  # not cached, retried next run
         if geocode_result:
-            x["formatted_address"] = geocode_result[0]["formatted_address"]
-            x["latitude"] = geocode_result[0]["geometry"]["location"]["lat"]
-            x["longitude"] = geocode_result[0]["geometry"]["location"]["lng"]
-        else:
-            x["formatted_address"] = None
-            x["latitude"] = None
-            x["longitude"] = None
-        return x
-
-    if not df.empty:
-        df = df.apply(apply_geoinfo, axis=1)
+            return {
+                "address": key,
+                "formatted_address": geocode_result[0]["formatted_address"],
+                "latitude": geocode_result[0]["geometry"]["location"]["lat"],
+                "longitude": geocode_result[0]["geometry"]["location"]["lng"],
+                "found": True
+            }
+        return {"address": key, "formatted_address": None, "latitude": None, "longitude": None, "found": False}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [r for r in executor.map(geocode, addresses.items()) if r is not None]
+
+    return results
+
+
+def add_geo_info(df):
+    # WARNING!! Limit to 40k request monthly. Only unique addresses missing from geocode_cache are requested.
+    logging.info("Adding geographic info")
+    if df.empty:
+        return df
+
+    address_keys = [normalize_address(a) for a in df["full_street_city"]]
+    unique_addresses = {}
+    for key, address in zip(address_keys, df["full_street_city"]):
+        if key is not None:
+            unique_addresses.setdefault(key, address)
+
+    create_geocode_cache_table()
+    geo_info = read_geocode_cache(unique_addresses)
+    missing = {k: a for k, a in unique_addresses.items() if k not in geo_info}
+    logging.info(f"{len(unique_addresses)} unique addresses, {len(missing)} not cached")
+
+    if missing:
+        results = geocode_addresses(missing)
+        if results:
+            df_cache = pd.DataFrame(results)
+            df_cache["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
+            upsert_dataframe(df_cache, "geocode_cache", key="address")
+        geo_info.update({r["address"]: r for r in results})
+
+    df = df.copy()
+    for c in ("formatted_address", "latitude", "longitude"):
+        df[c] = [geo_info.get(key, {}).get(c) for key in address_keys]
 
     return df
 
 
+def create_indexes():
+    # Partial indexes covering only the rows update_inactive_elements looks at
+    execute_update_query("""
+        CREATE INDEX IF NOT EXISTS houses_scrapper_inactive_id_idx ON houses_scrapper (id) WHERE NOT active;
+        CREATE INDEX IF NOT EXISTS houses_clean_active_id_idx ON houses_clean (id) WHERE active;
+    """)
+
+
 def update_inactive_elements():
-    q_read = """
-        SELECT hc.id
-        FROM houses_clean hc
-        INNER JOIN houses_scrapper hs
-        ON hc.id = hs.id
-        WHERE NOT hs.active AND hc.active
+    q_update = """
+        UPDATE houses_clean hc
+        SET active = false
+        FROM houses_scrapper hs
+        WHERE hc.id = hs.id
+            AND NOT hs.active
+            AND hc.active
     """
-    df = execute_query(q_read)
-    if not df.empty:
-        logging.info(f"Updating {df.shape[0]} inactive elements")
-        ids = df["id"].values.tolist()
-        placeholders = ",".join(["%s"] * len(ids))
-        q_update = f"UPDATE houses_clean SET active = false WHERE id IN ({placeholders});"
-        execute_update_query(q_update, params=tuple(ids))
+    updated = execute_update_query(q_update)
+    logging.info(f"Updated {updated} inactive elements")
+
+    return updated
 
 
 def pipeline():
@@ -109,6 +191,7 @@ def pipeline():
     df = filter_df(df)
     df = add_geo_info(df)
     upload_to_table(df, "houses_clean")
+    create_indexes()
     update_inactive_elements()
 
 
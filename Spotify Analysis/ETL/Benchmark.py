@@ -0,0 +1,146 @@
+"""Runs the Spotify ETLs against local stand-ins (fakes.py) and reports wall time, API calls, writes and peak RSS.
+
+Each ETL runs in its own process, so peak RSS is not shared between them:
+
+    python Benchmark.py --library-size 5000 --latency 0.05 --rate-limit 50
+"""
+import argparse
+import importlib
+import json
+import logging
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+etls = ["TrackData", "UserTopArtists", "UserRecentlyPlayed"]
+etl_kwargs = {
+    "TrackData": {"use_cache": False}
+}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024  # bytes on macOS, KB on Linux
+
+
+def run_etl(name, library_size, recent_plays, latency, rate_limit, raise_on_limit=False):
+    import common
+    import fakes
+    import metrics
+
+    api, ssm, dynamodb = fakes.install(
+        api=fakes.FakeSpotifyAPI(library_size=library_size, recent_plays=recent_plays, latency=latency,
+                                 rate_limit=rate_limit, raise_on_limit=raise_on_limit)
+    )
+    module = importlib.import_module(name)
+
+    start_t = time.perf_counter()
+    module.main(**etl_kwargs.get(name, {}))
+    wall_time = time.perf_counter() - start_t
+
+    return {
+        "etl": name,
+        "wall_time_s": round(wall_time, 3),
+        "api_calls": sum(api.calls.values()),
+        "api_calls_by_endpoint": dict(api.calls),
+        "api_throttled": api.throttled,
+        "limiter_rate": round(common.spotify_rate_limiter.rate, 2),
+        "limiter_concurrency": round(common.spotify_rate_limiter.concurrency, 2),
+        "ssm_calls": sum(ssm.calls.values()),
+        "items_written": dynamodb.stats["items_written"],
+        "bytes_written": dynamodb.stats["bytes_written"],
+        "write_units": dynamodb.stats["write_units"],
+        "write_requests": dynamodb.stats["write_requests"],
+        "items_read": dynamodb.stats["items_read"],
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": metrics.report()["stages"]
+    }
+
+
+def check_retry_after(retry_after=2):
+    # A real 429 sent through spotipy's HTTP layer must reach the shared limiter with its Retry-After header,
+    # instead of being retried (and slept on) by urllib3 inside the calling thread
+    import common
+    import fakes
+
+    server = fakes.FakeSpotifyHTTPServer([
+        (429, {"Retry-After": str(retry_after)}, {"error": {"status": 429, "message": "API rate limit exceeded"}}),
+        (200, {}, {"id": "track1"})
+    ])
+    limiter = common.RateLimiter(rate=100.0)
+    try:
+        sp = common.new_spotify_client("token", limiters=(limiter,), prefix=server.prefix)
+        start_t = time.perf_counter()
+        response = sp.track("track1")
+        elapsed = time.perf_counter() - start_t
+    finally:
+        server.close()
+
+    report = {
+        "check": "retry_after",
+        "requests": len(server.requests),
+        "limiter_throttles": limiter.throttles,
+        "waited_s": round(elapsed, 3),
+        "response_id": response["id"]
+    }
+    report["ok"] = (report["requests"] == 2 and limiter.throttles == 1 and elapsed >= retry_after
+                    and response["id"] == "track1")
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--etl", choices=etls, action="append", help="ETL to run, can be repeated (default: all)")
+    parser.add_argument("--library-size", type=int, default=1000, help="number of saved tracks")
+    parser.add_argument("--recent-plays", type=int, default=500, help="number of plays in the listening history")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API call")
+    parser.add_argument("--rate-limit", type=float, default=None, help="API requests per second")
+    parser.add_argument("--raise-on-limit", action="store_true",
+                        help="answer requests over the rate limit with 429 + Retry-After instead of delaying them")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--check-retry-after", action="store_true",
+                        help="send a real 429 through spotipy to a local server and check the limiter honours it")
+    parser.add_argument("--run", choices=etls, help=argparse.SUPPRESS)  # single ETL, used by the child processes
+    args = parser.parse_args()
+
+    if args.check_retry_after:
+        report = check_retry_after()
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report["ok"] else 1)
+
+    if args.run:
+        logging.disable(logging.INFO)
+        report = run_etl(args.run, args.library_size, args.recent_plays, args.latency, args.rate_limit,
+                         args.raise_on_limit)
+        print(json.dumps(report))
+        return
+
+    reports = []
+    for name in args.etl or etls:
+        command = [sys.executable, __file__, "--run", name, "--library-size", str(args.library_size),
+                   "--recent-plays", str(args.recent_plays), "--latency", str(args.latency)]
+        if args.rate_limit is not None:
+            command += ["--rate-limit", str(args.rate_limit)]
+        if args.raise_on_limit:
+            command.append("--raise-on-limit")
+        process = subprocess.run(command, capture_output=True, text=True, check=True)
+        reports.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    output = json.dumps(reports, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,160 @@
+import hashlib
+import json
+import logging
 import os
 import platform
+import shutil
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from common import read_full_dynamo_table
+from metrics import write_report
 
-top_artists = read_full_dynamo_table("top_artists")
-recently_played = read_full_dynamo_table("recently_played")
+analysis_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Analysis")
+export_path = os.path.join(analysis_path, "export")
+export_tables = {
+    # Current state: the dataset is replaced whenever the table changes, so dropped artists disappear
+    "top_artists": {"partition_cols": ["time_range"], "mode": "overwrite"},
+    # Append-only history: only plays not exported yet are appended
+    "recently_played": {"partition_cols": ["played_date"], "mode": "append",
+                        "keys": ["played_date", "played_at"], "order_column": "played_at"}
+}
+append_retention = timedelta(days=30)  # keys older than this before the newest exported row are dropped from the state
+_excluded_columns = {"run_id"}  # left on rows by older full-table refreshes, differs on every run
 
-top_artists = pd.DataFrame(top_artists)
-recently_played = pd.DataFrame(recently_played)
+logging.basicConfig(level=logging.INFO)
 
-if platform.system() == "Windows":
-    os.chdir("..")
-    top_artists.to_csv("Analysis\\top_artists_last.csv")
-    recently_played.to_csv("Analysis\\recently_played_last.csv")
-else:
-    pass
-    # if executed in a cloud service, file management should be included here.
-    # Files could be uploaded to s3 or another service to later be consumed by Tableau.
+
+def to_typed_dataframe(items):
+    df = pd.DataFrame(items)
+    df = df.drop(columns=[c for c in _excluded_columns if c in df.columns])
+    for c in df.columns:
+        if df[c].map(lambda v: isinstance(v, Decimal)).any():
+            df[c] = pd.to_numeric(df[c].map(lambda v: float(v) if isinstance(v, Decimal) else v))
+
+    return df
+
+
+def row_hashes(df):
+    records = df.to_dict("records")
+    return [hashlib.sha1(json.dumps(r, sort_keys=True, default=str).encode()).hexdigest() for r in records]
+
+
+def table_hash(df):
+    return hashlib.sha1("".join(sorted(row_hashes(df))).encode()).hexdigest()
+
+
+def row_keys(df, keys):
+    return [json.dumps(k, default=str) for k in df[keys].itertuples(index=False, name=None)]
+
+
+def load_export_state(table_dir):
+    state_file = os.path.join(table_dir, "_export_state.json")
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_export_state(table_dir, state):
+    state_file = os.path.join(table_dir, "_export_state.json")
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def write_dataset(df, table_dir, partition_cols=None, compression="zstd"):
+    df = df.copy()
+    df["exported_at"] = datetime.now(timezone.utc)
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), table_dir,
+                        partition_cols=partition_cols, compression=compression,
+                        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet")
+
+
+def overwrite_table(df, table_dir, partition_cols=None, compression="zstd"):
+    state = load_export_state(table_dir)
+    current_hash = table_hash(df)
+    if state.get("table_hash") == current_hash:
+        return 0
+
+    # Written next to the old dataset and swapped in, so readers never see a half-written table
+    new_dir = f"{table_dir}.{uuid.uuid4().hex}.tmp"
+    write_dataset(df, new_dir, partition_cols=partition_cols, compression=compression)
+    save_export_state(new_dir, {"table_hash": current_hash})
+    old_dir = f"{table_dir}.{uuid.uuid4().hex}.old"
+    os.replace(table_dir, old_dir)
+    os.replace(new_dir, table_dir)
+    shutil.rmtree(old_dir)
+
+    return df.shape[0]
+
+
+def append_table(df, table_dir, keys, order_column, partition_cols=None, compression="zstd"):
+    state = load_export_state(table_dir)
+    exported = state.get("rows", {})
+    cutoff = state.get("cutoff")
+
+    row_ids = row_keys(df, keys)
+    is_new = pd.Series([k not in exported for k in row_ids], index=df.index)
+    if cutoff is not None:
+        is_new &= df[order_column] >= cutoff  # older rows were exported before the state was pruned
+    if "row_hashes" in state:  # state written before exports were keyed by primary key
+        legacy = set(state["row_hashes"])
+        is_new &= pd.Series([h not in legacy for h in row_hashes(df)], index=df.index)
+
+    df_new = df.loc[is_new]
+    if not df_new.empty:
+        write_dataset(df_new, table_dir, partition_cols=partition_cols, compression=compression)
+
+    exported.update(zip(row_ids, df[order_column].astype(str)))
+    newest = pd.to_datetime(max(exported.values()), utc=True)
+    new_cutoff = (newest - append_retention).strftime("%Y-%m-%dT%H:%M:%S")
+    if cutoff is not None:
+        new_cutoff = max(cutoff, new_cutoff)
+    exported = {k: v for k, v in exported.items() if v >= new_cutoff}
+    save_export_state(table_dir, {"cutoff": new_cutoff, "rows": exported})
+
+    return df_new.shape[0]
+
+
+def export_table(table_name, path=export_path, partition_cols=None, compression="zstd",
+                 mode="overwrite", keys=None, order_column=None):
+    table_dir = os.path.join(path, table_name)
+    os.makedirs(table_dir, exist_ok=True)
+
+    items = read_full_dynamo_table(table_name, segments=4)
+    df = to_typed_dataframe(items)
+    if df.empty:
+        logging.info(f"{table_name}: nothing to export")
+        return df
+
+    if mode == "append":
+        exported = append_table(df, table_dir, keys, order_column, partition_cols=partition_cols,
+                                compression=compression)
+    else:
+        exported = overwrite_table(df, table_dir, partition_cols=partition_cols, compression=compression)
+
+    if exported:
+        logging.info(f"{table_name}: exported {exported} rows of {df.shape[0]} ({mode})")
+    else:
+        logging.info(f"{table_name}: no changes since last export")
+
+    return df
+
+
+def main(path=export_path, write_csv=platform.system() == "Windows"):
+    for table_name, options in export_tables.items():
+        df = export_table(table_name, path=path, **options)
+        if write_csv:
+            # CSVs read by the Tableau dashboard
+            df.to_csv(os.path.join(analysis_path, f"{table_name}_last.csv"))
+
+
+if __name__ == "__main__":
+    main()
+    write_report("TableauFiles")
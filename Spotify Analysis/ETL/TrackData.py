@@ -1,33 +1,86 @@
 import logging
-from statistics import mean
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from common import get_spotipy_client, read_full_dynamo_table, load_to_dynamo, parse_numeric_data, user_lib_scope
+import numpy as np
+
+from common import get_spotipy_client, scan_dynamo_table, load_to_dynamo, parse_numeric_data, user_lib_scope, \
+    get_watermark, set_watermark, encode_sections, get_track_sections, ResponseCache, user_key, batched
+from metrics import write_report
 
 valid_audio_features = ["danceability", "energy", "key", "loudness", "mode", "speechiness", "acousticness",
                         "instrumentalness", "liveness", "valence", "tempo"]
 
 _limit = 50
+_analysis_workers = 8
+_paging_workers = 8
+_batch_size = 200
+_write_workers = 4
+_artist_ttl = 30 * 24 * 3600  # genres change rarely, refresh cached artists monthly
+_saved_tracks_watermark = "saved_tracks"
+_failed_tracks_state = "saved_tracks:failed"  # ids whose analysis failed, retried on the next incremental run
+
+_confidence_threshold = 0.5
+_change_threshold = 0.05  # 5% change
+_dynamics_threshold = 0.1  # no confidence, wider interval
+_confidence_features = {
+    "tempo": "tempo_changes",
+    "key": "key_changes",
+    "mode": "mode_changes",
+    "time_signature": "time_signature_changes"
+}
 
 logging.basicConfig(level=logging.INFO)
 
 
-def get_saved_tracks():
+def get_saved_tracks(workers=_paging_workers, user_id=None):
     logging.info("Getting saved tracks...")
-    sp = get_spotipy_client(user_lib_scope)
+    sp = get_spotipy_client(user_lib_scope, user_id)
+
+    # The first page reports the library size, so the remaining offsets can be fetched concurrently
+    first_page = sp.current_user_saved_tracks(limit=_limit)
+    offsets = range(_limit, first_page["total"], _limit)
+
+    def get_page(offset):
+        return sp.current_user_saved_tracks(limit=_limit, offset=offset)["items"]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = [first_page["items"], *executor.map(get_page, offsets)]
+
+    return [item["track"] for page in pages for item in page]
+
 
-    all_results = []
+def get_new_saved_tracks(watermark, user_id=None):
+    # Saved tracks come newest-first, so paging stops at the first track already seen in a previous run
+    logging.info(f"Getting saved tracks added since {watermark['added_at']}...")
+    sp = get_spotipy_client(user_lib_scope, user_id)
+
+    new_items = []
 
     offset = 0
-    results = sp.current_user_saved_tracks(limit=_limit)
-    while results["next"] is not None:
-        if offset > 0:
-            results = sp.current_user_saved_tracks(limit=_limit, offset=offset)
-        for idx, item in enumerate(results['items']):
-            track = item['track']
-            all_results.append(track)
+    while True:
+        results = sp.current_user_saved_tracks(limit=_limit, offset=offset)
+        for item in results["items"]:
+            if item["track"]["id"] == watermark["track_id"] or item["added_at"] < watermark["added_at"]:
+                return new_items
+            new_items.append(item)
+        if results["next"] is None:
+            return new_items
         offset += _limit
 
-    return all_results
+
+def get_tracks(track_ids, user_id=None):
+    sp = get_spotipy_client(user_lib_scope, user_id)
+    tracks = []
+    for i in range(0, len(track_ids), 50):
+        tracks.extend(t for t in sp.tracks(track_ids[i:i + 50])["tracks"] if t is not None)
+
+    return tracks
+
+
+def to_watermark(item):
+    return {"added_at": item["added_at"], "track_id": item["track"]["id"]}
 
 
 def clean_data(track):
@@ -56,29 +109,92 @@ def clean_data(track):
     return track_info
 
 
-def get_change_in_feature(element, past_element, feature):
-    if past_element[f"{feature}_confidence"] > 0.5 and element[f"{feature}_confidence"] > 0.5:  # enough confidence
-        try:
-            if abs(past_element[feature] - element[feature]) / element[feature] > 0.05:  # 5% change
-                return True
-        except ZeroDivisionError:
-            return False
-    return False
+def _relative_change(previous, current, threshold):
+    # abs(previous - current) / current, where a zero current value never counts as a change
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.abs(previous - current) / current
+    return (current != 0) & (change > threshold)
+
+
+def compute_section_features(tracks_sections, confidence_threshold=_confidence_threshold,
+                             change_threshold=_change_threshold, dynamics_threshold=_dynamics_threshold):
+    num_tracks = len(tracks_sections)
+    num_sections = np.array([len(sections) for sections in tracks_sections])
+    track_idx = np.repeat(np.arange(num_tracks), num_sections)
+    all_sections = [section for sections in tracks_sections for section in sections]
+
+    def column(field):
+        return np.array([section[field] for section in all_sections], dtype=np.float64)
+
+    # Consecutive sections are only compared within the same track
+    pairs = track_idx[1:] == track_idx[:-1]
+    pair_track_idx = track_idx[1:]
+
+    def count_per_track(changes):
+        return np.bincount(pair_track_idx[pairs & changes], minlength=num_tracks)
+
+    counts = {}
+    for feature, output in _confidence_features.items():
+        values = column(feature)
+        confidence = column(f"{feature}_confidence")
+        confident = (confidence[:-1] > confidence_threshold) & (confidence[1:] > confidence_threshold)
+        counts[output] = count_per_track(confident & _relative_change(values[:-1], values[1:], change_threshold))
+
+    loudness = column("loudness")
+    counts["dynamics_changes"] = count_per_track(_relative_change(loudness[:-1], loudness[1:], dynamics_threshold))
+
+    total_duration = np.bincount(track_idx, weights=column("duration"), minlength=num_tracks)
+    avg_duration = np.divide(total_duration, num_sections, out=np.zeros(num_tracks), where=num_sections > 0)
+
+    results = []
+    for i in range(num_tracks):
+        features = {
+            "num_sections": int(num_sections[i]),
+            "sections_avg_duration": float(avg_duration[i])
+        }
+        features.update({output: int(values[i]) for output, values in counts.items()})
+        results.append(features)
+
+    return results
 
 
-def get_audio_features(tracks):
+def recompute_library_section_features(**thresholds):
+    items = list(scan_dynamo_table("track_info", attributes=["track_id", "raw_sections", "sections_encoded"]))
+    sections = [get_track_sections(item) for item in items]
+    features = compute_section_features(sections, **thresholds)
+
+    return [{"track_id": item["track_id"], **f} for item, f in zip(items, features)]
+
+
+def get_audio_features(tracks, cache=None, user_id=None):
     logging.info("Getting audio features...")
-    sp = get_spotipy_client(user_lib_scope)
-    chunks = [tracks[i:i + 100] for i in range(0, len(tracks), 100)]
-    features_results = []
+    sp = get_spotipy_client(user_lib_scope, user_id)
+    ids = [e["track_id"] for e in tracks]
+    features_by_id = {}
+
+    if cache is not None:
+        for track_id in ids:
+            feature = cache.get("audio_features", track_id)
+            if feature is not None:
+                features_by_id[track_id] = feature
+
+    missing_ids = [track_id for track_id in ids if track_id not in features_by_id]
+    chunks = [missing_ids[i:i + 100] for i in range(0, len(missing_ids), 100)]
 
     for chunk in chunks:
-        ids = [e["track_id"] for e in chunk]
-        features = sp.audio_features(ids)
-        features_results.extend(features)
+        features = sp.audio_features(chunk)
+        for track_id, feature in zip(chunk, features):
+            features_by_id[track_id] = feature
+            if cache is not None and feature is not None:
+                cache.put("audio_features", track_id, feature)
+
+    features_results = [features_by_id[track_id] for track_id in ids]
 
     results = []
     for track, feature in zip(tracks, features_results):
+        if feature is None:  # Spotify has no audio features for this track, it is left out as failed
+            logging.warning(f"No audio features for track {track['track_id']}")
+            continue
         new_feature = {k: v for k, v in feature.items() if k in valid_audio_features}
         new_feature = {**track, **new_feature}
         results.append(new_feature)
@@ -86,70 +202,87 @@ def get_audio_features(tracks):
     return results
 
 
-def get_advanced_audio_features(track):
-    sp = get_spotipy_client(user_lib_scope)
+def get_advanced_audio_features(track, compact_sections=False, cache=None, user_id=None):
+    sp = get_spotipy_client(user_lib_scope, user_id)
     track_id = track["track_id"]
-    features = sp.audio_analysis(track_id)
+    if cache is not None:
+        features = cache.get_or_fetch("audio_analysis", track_id, lambda: sp.audio_analysis(track_id))
+    else:
+        features = sp.audio_analysis(track_id)
     sections = features["sections"]
 
-    track_info = {**track, "raw_sections": sections}
-
-    num_sections = len(sections)
-    sections_avg_duration = mean([e["duration"] for e in sections])
-
-    tempo_changes = 0
-    key_changes = 0
-    mode_changes = 0
-    time_signature_changes = 0
-    dynamics_changes = 0
-
-    for i in range(1, len(sections)):
-        if get_change_in_feature(sections[i], sections[i - 1], "tempo"):
-            tempo_changes += 1
-        if get_change_in_feature(sections[i], sections[i - 1], "key"):
-            key_changes += 1
-        if get_change_in_feature(sections[i], sections[i - 1], "mode"):
-            mode_changes += 1
-        if get_change_in_feature(sections[i], sections[i - 1], "time_signature"):
-            time_signature_changes += 1
-        if abs(sections[i - 1]["loudness"] - sections[i]["loudness"]) / sections[i][
-            "loudness"] > 0.1:  # no confidence, wider interval
-            dynamics_changes += 1
-
-    track_info["num_sections"] = num_sections
-    track_info["sections_avg_duration"] = sections_avg_duration
-    track_info["tempo_changes"] = tempo_changes
-    track_info["key_changes"] = key_changes
-    track_info["mode_changes"] = mode_changes
-    track_info["time_signature_changes"] = time_signature_changes
-    track_info["dynamics_changes"] = dynamics_changes
+    if compact_sections:
+        track_info = {**track, "sections_encoded": encode_sections(sections)}
+    else:
+        track_info = {**track, "raw_sections": sections}
+
+    track_info.update(compute_section_features([sections])[0])
 
     return track_info
 
 
-def add_track_genre(tracks):
+def _safe_advanced_audio_features(track, compact_sections=False, cache=None, user_id=None):
+    try:
+        return get_advanced_audio_features(track, compact_sections=compact_sections, cache=cache, user_id=user_id)
+    except Exception as e:
+        logging.warning(f"Failed to get audio analysis for track {track['track_id']}: {e}")
+        return None
+
+
+def get_all_advanced_audio_features(tracks, workers=_analysis_workers, compact_sections=False, cache=None,
+                                    user_id=None):
+    start_t = time.perf_counter()
+    fetch = partial(_safe_advanced_audio_features, compact_sections=compact_sections, cache=cache, user_id=user_id)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fetch, tracks))
+    else:
+        results = [fetch(track) for track in tracks]
+
+    failed = sum(1 for r in results if r is None)
+    results = [r for r in results if r is not None]
+
+    elapsed = time.perf_counter() - start_t
+    rate = len(tracks) / elapsed if elapsed > 0 else 0
+    logging.info(f"Audio analysis: {len(results)} ok, {failed} failed in {elapsed:.1f}s "
+                 f"({rate:.1f} tracks/s, {workers} workers)")
+
+    return results
+
+
+def add_track_genre(tracks, cache=None, user_id=None):
     logging.info("Adding genres...")
-    sp = get_spotipy_client(user_lib_scope)
+    sp = get_spotipy_client(user_lib_scope, user_id)
 
     unique_artists = list(set([t["artist_id"] for t in tracks]))
+    artist_genres = {}
+
+    if cache is not None:
+        for artist_id in unique_artists:
+            artist = cache.get("artists", artist_id, max_age=_artist_ttl)
+            if artist is not None:
+                artist_genres[artist_id] = artist["genres"]
 
-    chunks = [unique_artists[i:i + 50] for i in range(0, len(unique_artists), 50)]
-    unique_artists_info = []
+    missing_artists = [artist_id for artist_id in unique_artists if artist_id not in artist_genres]
+    chunks = [missing_artists[i:i + 50] for i in range(0, len(missing_artists), 50)]
 
     for chunk in chunks:
         response = sp.artists(chunk)
-        response = response["artists"]
-        unique_artists_info.extend(response)
-
-    artist_genres = {artist["name"]: artist["genres"] for artist in unique_artists_info}
+        for artist in response["artists"]:
+            if artist is None:
+                continue
+            artist_genres[artist["id"]] = artist["genres"]
+            if cache is not None:
+                cache.put("artists", artist["id"], {"name": artist["name"], "genres": artist["genres"]})
 
     for track in tracks:
-        track["genres"] = artist_genres[track["artist"]]
+        track["genres"] = artist_genres.get(track["artist_id"], [])
 
 
 def filter_new_tracks(tracks):
     logging.info("Filtering tracks...")
-    saved_tracks = read_full_dynamo_table("track_info")
+    saved_tracks = scan_dynamo_table("track_info", attributes=["track_id"])
     saved_ids = {track["track_id"] for track in saved_tracks}
 
     filtered_tracks = []
@@ -160,27 +293,106 @@ def filter_new_tracks(tracks):
     return filtered_tracks
 
 
-def main(filter_tracks=True):
-    all_tracks = get_saved_tracks()
-
-    if filter_tracks:
-        all_tracks = filter_new_tracks(all_tracks)
-
-    results = []
+def get_latest_watermark(user_id=None):
+    sp = get_spotipy_client(user_lib_scope, user_id)
+    results = sp.current_user_saved_tracks(limit=1)
+    if not results["items"]:
+        return None
+
+    return to_watermark(results["items"][0])
+
+
+def process_batches(batches, workers=_analysis_workers, compact_sections=False, cache=None, user_id=None):
+    # Each batch goes through every stage before the next one is read, so memory is bounded by batch_size
+    for batch in batches:
+        clean_tracks = [clean_data(track) for track in batch]
+        results = get_all_advanced_audio_features(clean_tracks, workers=workers, compact_sections=compact_sections,
+                                                  cache=cache, user_id=user_id)
+        results = get_audio_features(results, cache=cache, user_id=user_id)
+        add_track_genre(results, cache=cache, user_id=user_id)
+        parse_numeric_data(results)
+        loaded_ids = {r["track_id"] for r in results}
+        failed_ids = {track["id"] for track in batch if track["id"] not in loaded_ids}
+        yield results, failed_ids
+
+
+def save_user_tracks(tracks, user_id):
+    # Track data in track_info is shared by every user, membership is kept per user
+    load_to_dynamo([{"user_id": user_id, "track_id": track["id"]} for track in tracks], "saved_tracks")
+
+
+def main(filter_tracks=True, workers=_analysis_workers, incremental=True, compact_sections=False,
+         use_cache=True, batch_size=_batch_size, write_workers=_write_workers, user_id=None):
+    cache = ResponseCache() if use_cache else None
+    watermark_name = user_key(_saved_tracks_watermark, user_id)
+
+    failed_name = user_key(_failed_tracks_state, user_id)
+
+    watermark = get_watermark(watermark_name) if incremental else None
+
+    if watermark is not None:
+        # Oldest first, so the watermark can be moved forward after every loaded batch
+        new_items = list(reversed(get_new_saved_tracks(watermark, user_id=user_id)))
+        final_watermark = None
+        if user_id is not None and new_items:
+            # Tracks already analysed for another user only need the membership row
+            save_user_tracks([item["track"] for item in new_items], user_id)
+            final_watermark = to_watermark(new_items[-1])
+            new_ids = {t["id"] for t in filter_new_tracks([item["track"] for item in new_items])}
+            new_items = [item for item in new_items if item["track"]["id"] in new_ids]
+        # Tracks that failed in earlier runs are behind the watermark, so they are fetched by id and retried first
+        pending_ids = set(get_watermark(failed_name) or [])
+        new_ids = {item["track"]["id"] for item in new_items}
+        retry_tracks = get_tracks(sorted(pending_ids - new_ids), user_id=user_id)
+        pending_ids = {track["id"] for track in retry_tracks} | (pending_ids & new_ids)  # drop unavailable tracks
+        if retry_tracks:
+            logging.info(f"Retrying {len(retry_tracks)} tracks that failed in previous runs")
+        retry_batches = list(batched(retry_tracks, batch_size))
+        item_batches = list(batched(new_items, batch_size))
+        batch_watermarks = [None] * len(retry_batches) + [to_watermark(items[-1]) for items in item_batches]
+        track_batches = [*retry_batches, *([item["track"] for item in items] for items in item_batches)]
+    else:
+        # A full run goes over the whole library, so earlier failures are picked up again
+        pending_ids = set()
+        final_watermark = get_latest_watermark(user_id) if incremental else None
+        all_tracks = get_saved_tracks(user_id=user_id)
+        if user_id is not None:
+            save_user_tracks(all_tracks, user_id)
+        if filter_tracks or user_id is not None:
+            all_tracks = filter_new_tracks(all_tracks)
+        batch_watermarks = None
+        track_batches = batched(all_tracks, batch_size)
 
     logging.info("Getting extra features...")
-    for track in all_tracks:
-        clean_track = clean_data(track)
-        clean_track = get_advanced_audio_features(clean_track)
-        results.append(clean_track)
-
-    results = get_audio_features(results)
-    add_track_genre(results)
-    parse_numeric_data(results)
-    load_to_dynamo(results, "track_info")
+    loaded = 0
+    for i, (results, failed_ids) in enumerate(process_batches(track_batches, workers=workers,
+                                                              compact_sections=compact_sections, cache=cache,
+                                                              user_id=user_id)):
+        load_to_dynamo(results, "track_info", workers=write_workers)
+        loaded += len(results)
+        # Failed ids are saved before the watermark moves past them
+        previous_ids = set(pending_ids)
+        pending_ids = (pending_ids - {r["track_id"] for r in results}) | failed_ids
+        if incremental and pending_ids != previous_ids:
+            set_watermark(failed_name, sorted(pending_ids))
+        if batch_watermarks is not None and batch_watermarks[i] is not None:
+            set_watermark(watermark_name, batch_watermarks[i])
+        logging.info(f"Loaded batch {i + 1} ({loaded} tracks so far)")
+
+    if incremental and watermark is None:
+        set_watermark(failed_name, sorted(pending_ids))
+    if final_watermark is not None:
+        set_watermark(watermark_name, final_watermark)
+    if pending_ids:
+        logging.warning(f"{len(pending_ids)} tracks could not be analysed and will be retried on the next run")
+
+    if cache is not None:
+        logging.info(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
 
     logging.info("Finished!")
 
 
 if __name__ == "__main__":
     main()
+    write_report("TrackData")
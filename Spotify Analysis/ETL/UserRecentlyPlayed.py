@@ -1,23 +1,64 @@
-from common import get_spotipy_client, load_to_dynamo, user_recently_played_scope
+from datetime import datetime
 
+from common import get_spotipy_client, load_to_dynamo, user_recently_played_scope, get_watermark, set_watermark, \
+    user_key
+from metrics import write_report
 
-def get_recently_played(limit=25):
-    sp = get_spotipy_client(user_recently_played_scope)
-    response = sp.current_user_recently_played(limit=limit)
+_limit = 50  # maximum allowed by the API
+_recently_played_watermark = "recently_played"
+
+
+def played_at_ms(played_at):
+    return int(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def get_recently_played(after=None, limit=_limit, user_id=None):
+    # Plays after the cursor, following the cursor forward until a page comes back short
+    sp = get_spotipy_client(user_recently_played_scope, user_id)
 
     results = []
-    for track in response["items"]:
-        track_info = {
-            "track_name": track["track"]["name"],
-            "album": track["track"]["album"]["name"],
-            "artist": track["track"]["artists"][0]["name"],
-            "url": track["track"]["external_urls"]["spotify"],
-        }
-        results.append(track_info)
-
-    results = [dict(t) for t in {tuple(d.items()) for d in results}]
+    while True:
+        if after is not None:
+            response = sp.current_user_recently_played(limit=limit, after=after)
+        else:
+            response = sp.current_user_recently_played(limit=limit)
+
+        for track in response["items"]:
+            track_info = {
+                "played_date": user_key(track["played_at"][:10], user_id),
+                "played_at": track["played_at"],
+                "track_id": track["track"]["id"],
+                "track_name": track["track"]["name"],
+                "album": track["track"]["album"]["name"],
+                "artist": track["track"]["artists"][0]["name"],
+                "url": track["track"]["external_urls"]["spotify"],
+            }
+            if user_id is not None:
+                track_info["user_id"] = user_id
+            results.append(track_info)
+
+        if after is None or len(response["items"]) < limit:
+            break
+        newest = max(played_at_ms(track["played_at"]) for track in response["items"])
+        if after is not None and newest <= after:
+            break
+        after = newest
+
     return results
 
 
-results = get_recently_played()
-load_to_dynamo(results, "recently_played", empty_table=True)
+def main(user_id=None):
+    watermark_name = user_key(_recently_played_watermark, user_id)
+    after = get_watermark(watermark_name)
+    results = get_recently_played(after=int(after) if after is not None else None, user_id=user_id)
+    if not results:
+        return
+
+    # (played_date, played_at) is the table key, so a play collected twice is just overwritten
+    load_to_dynamo(results, "recently_played")
+    set_watermark(watermark_name, max(played_at_ms(r["played_at"]) for r in results))
+
+
+if __name__ == "__main__":
+    main()
+    write_report("UserRecentlyPlayed")
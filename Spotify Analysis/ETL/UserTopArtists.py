@@ -1,8 +1,9 @@
-from common import get_spotipy_client, load_to_dynamo, parse_numeric_data, user_top_scope
-import uuid
+from common import get_spotipy_client, sync_dynamo_table, parse_numeric_data, user_top_scope, user_key
+from metrics import write_report
 
-def get_top_artists(limit=20):
-    sp = get_spotipy_client(user_top_scope)
+
+def get_top_artists(limit=20, user_id=None):
+    sp = get_spotipy_client(user_top_scope, user_id)
     results = []
 
     for time_range in ("short_term", "medium_term", "long_term"):
@@ -10,7 +11,8 @@ def get_top_artists(limit=20):
 
         for artist in response["items"]:
             artist_info = {
-                "id": str(uuid.uuid4()),
+                "id": user_key(f"{artist['id']}#{time_range}", user_id),
+                "artist_id": artist["id"],
                 "artist_name": artist["name"],
                 "genres": artist["genres"],
                 "followers": artist["followers"]["total"],
@@ -18,11 +20,19 @@ def get_top_artists(limit=20):
                 "img": artist["images"][0]["url"],
                 "url": artist["external_urls"]["spotify"]
             }
+            if user_id is not None:
+                artist_info["user_id"] = user_id
             results.append(artist_info)
 
     return results
 
 
-results = get_top_artists()
-parse_numeric_data(results)
-load_to_dynamo(results, "top_artists", empty_table=True)
+def main(user_id=None):
+    results = get_top_artists(user_id=user_id)
+    parse_numeric_data(results)
+    sync_dynamo_table(results, "top_artists", user_id=user_id)
+
+
+if __name__ == "__main__":
+    main()
+    write_report("UserTopArtists")
@@ -1,9 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from decimal import Context
+import json
+import logging
+import os
 import platform
+import queue
+import sqlite3
+import threading
+import time
+import zlib
 
 import boto3
+import numpy as np
+import requests
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+
+import metrics
 
 user_lib_scope = "user-library-read"
 user_top_scope = "user-top-read"
@@ -15,6 +31,48 @@ scope_mapping = {
     user_recently_played_scope: "SPOTIFY_REFRESH_TOKEN_RECENTLE_PLAYED"
 }
 redirect_uri = "http://localhost:8889/callback"
+user_parameter_prefix = "/spotify/users"
+
+_token_expiry_margin = 60  # seconds before expiry at which a token is refreshed
+_secrets_cache = {}
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+_client_locks = {}  # one per (scope, user_id), held while that client's token is refreshed
+client_cache_stats = {"hits": 0, "misses": 0}
+
+state_table_name = "etl_state"
+user_index_name = "user_id-index"  # GSI keyed by "user_id" (all attributes projected) on tables synced per user
+
+_write_executors = {}
+_write_executors_lock = threading.Lock()
+_writer_local = threading.local()
+
+_throttling_errors = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+
+_sections_encoding_version = 3
+# (field, dtype, scale): Spotify reports times with 5 decimals and everything else with 3, so those values are stored
+# exactly as integers of 1/scale units. A column that does not fit is kept as float64 instead, so decoding is lossless.
+_section_fields = [
+    ("start", np.int64, 100000), ("duration", np.int64, 100000), ("confidence", np.int16, 1000),
+    ("loudness", np.int32, 1000), ("tempo", np.int32, 1000), ("tempo_confidence", np.int16, 1000),
+    ("key", np.int8, 1), ("key_confidence", np.int16, 1000), ("mode", np.int8, 1),
+    ("mode_confidence", np.int16, 1000), ("time_signature", np.int8, 1), ("time_signature_confidence", np.int16, 1000)
+]
+_section_fields_v2 = [
+    ("duration", np.uint16, 10), ("confidence", np.uint8, 255), ("loudness", np.int16, 100),
+    ("tempo", np.uint16, 100), ("tempo_confidence", np.uint8, 255), ("key", np.int8, 1),
+    ("key_confidence", np.uint8, 255), ("mode", np.int8, 1), ("mode_confidence", np.uint8, 255),
+    ("time_signature", np.int8, 1), ("time_signature_confidence", np.uint8, 255)
+]
+_section_record_size_v2 = sum(np.dtype(dtype).itemsize for _, dtype, _ in _section_fields_v2)
+_column_float, _column_fixed, _column_gaps = 0, 1, 2
+_section_fields_v1 = [
+    ("start", np.float32), ("duration", np.float32), ("confidence", np.float32), ("loudness", np.float32),
+    ("tempo", np.float32), ("tempo_confidence", np.float32), ("key", np.int8), ("key_confidence", np.float32),
+    ("mode", np.int8), ("mode_confidence", np.float32), ("time_signature", np.int8),
+    ("time_signature_confidence", np.float32)
+]
+_section_record_size_v1 = sum(np.dtype(dtype).itemsize for _, dtype in _section_fields_v1)
 
 if platform.system() == "Windows":
     cache_path = None
@@ -23,6 +81,8 @@ else:
     cache_path = "/tmp/.cache"
     profile = None
 
+response_cache_path = os.path.join(os.path.expanduser("~"), ".cache", "spotify_etl", "responses.sqlite")
+
 def parse_numeric_data(data):
     ctx = Context(prec=5)
 
@@ -37,51 +97,695 @@ def parse_numeric_data(data):
                             e[k2] = ctx.create_decimal_from_float(v2)
 
 
-def get_spotipy_client(scope):
-    ssm = boto3.client("ssm", region_name="eu-west-1")
-    client_secret = ssm.get_parameter(Name="SPOTIFY_CLIENT_SECRET", WithDecryption=True)
-    client_secret = client_secret["Parameter"]["Value"]
-    client_id = ssm.get_parameter(Name="SPOTIFY_CLIENT_ID", WithDecryption=True)
-    client_id = client_id["Parameter"]["Value"]
-    refresh_token = ssm.get_parameter(Name=scope_mapping[scope], WithDecryption=True)
-    refresh_token = refresh_token["Parameter"]["Value"]
+def user_key(value, user_id=None):
+    # Single-user runs keep the original keys, multi-user runs prefix them with the user id
+    return value if user_id is None else f"{user_id}#{value}"
+
+
+def refresh_token_parameter(scope, user_id=None):
+    if user_id is None:
+        return scope_mapping[scope]
+    return f"{user_parameter_prefix}/{user_id}/{scope_mapping[scope]}"
+
+
+def get_ssm_parameters(names):
+    missing = [name for name in names if name not in _secrets_cache]
+    if missing:
+        ssm = boto3.client("ssm", region_name="eu-west-1")
+        response = ssm.get_parameters(Names=missing, WithDecryption=True)
+        if response["InvalidParameters"]:
+            raise KeyError(f"SSM parameters not found: {response['InvalidParameters']}")
+        for parameter in response["Parameters"]:
+            _secrets_cache[parameter["Name"]] = parameter["Value"]
+
+    return [_secrets_cache[name] for name in names]
+
+
+def _to_fixed(values, dtype, scale):
+    fixed = np.rint(values * scale)
+    limits = np.iinfo(dtype)
+    if fixed.size and (fixed.min() < limits.min or fixed.max() > limits.max):
+        return None
+    if not np.array_equal(fixed / scale, values):
+        return None
+    return fixed.astype(dtype)
+
+
+def _shuffle(values):
+    # Groups the n-th byte of every value together, which lets zlib drop the mostly constant high bytes
+    return values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+
+def _unshuffle(raw, dtype, count, offset):
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.frombuffer(raw, dtype=np.uint8, count=count * itemsize, offset=offset).reshape(itemsize, count)
+    return planes.T.copy().view(dtype).ravel()
+
+
+def encode_sections(sections):
+    # Column oriented: each field becomes a contiguous typed array, then the whole blob is compressed
+    num_sections = len(sections)
+    columns = {field: np.array([section[field] for section in sections], dtype=np.float64)
+               for field, _, _ in _section_fields}
+    kinds = []
+    payload = []
+    for field, dtype, scale in _section_fields:
+        fixed = _to_fixed(columns[field], dtype, scale)
+        if fixed is None:
+            kinds.append(_column_float)
+            payload.append(_shuffle(columns[field]))
+        elif field == "start":
+            # Sections are usually back to back, so start is stored as the gap after the previous section's end
+            duration = _to_fixed(columns["duration"], np.int64, scale)
+            if duration is None:
+                kinds.append(_column_fixed)
+                payload.append(_shuffle(fixed))
+            else:
+                previous_end = np.concatenate([[0], fixed[:-1] + duration[:-1]]).astype(np.int64)
+                kinds.append(_column_gaps)
+                payload.append(_shuffle(fixed - previous_end))
+        else:
+            kinds.append(_column_fixed)
+            payload.append(_shuffle(fixed))
+
+    header = np.array(num_sections, dtype=np.uint32).tobytes() + bytes(kinds)
+
+    return bytes([_sections_encoding_version]) + zlib.compress(header + b"".join(payload), 9)
+
+
+def _decode_sections_v1(raw):
+    num_sections = len(raw) // _section_record_size_v1
+
+    columns = {}
+    offset = 0
+    for field, dtype in _section_fields_v1:
+        columns[field] = np.frombuffer(raw, dtype=dtype, count=num_sections, offset=offset).tolist()
+        offset += num_sections * np.dtype(dtype).itemsize
+
+    return [{field: columns[field][i] for field, _ in _section_fields_v1} for i in range(num_sections)]
+
+
+def _decode_sections_v2(raw):
+    first_start = float(np.frombuffer(raw, dtype=np.float32, count=1)[0])
+    num_sections = (len(raw) - 4) // _section_record_size_v2
+
+    columns = {}
+    offset = 4
+    for field, dtype, scale in _section_fields_v2:
+        values = np.frombuffer(raw, dtype=dtype, count=num_sections, offset=offset)
+        columns[field] = values.tolist() if scale == 1 else (values / scale).tolist()
+        offset += num_sections * np.dtype(dtype).itemsize
+    starts = first_start + np.concatenate([[0.0], np.cumsum(columns["duration"])[:-1]])
+    columns["start"] = starts.tolist()[:num_sections]
+
+    return [{"start": columns["start"][i], **{field: columns[field][i] for field, _, _ in _section_fields_v2}}
+            for i in range(num_sections)]
+
+
+def decode_sections(blob):
+    blob = bytes(getattr(blob, "value", blob))  # boto3 returns Binary objects
+    if blob[0] not in (1, 2, _sections_encoding_version):
+        raise ValueError(f"Unknown sections encoding version {blob[0]}")
+    raw = zlib.decompress(blob[1:])
+    if blob[0] == 1:
+        return _decode_sections_v1(raw)
+    if blob[0] == 2:
+        return _decode_sections_v2(raw)
+
+    num_sections = int(np.frombuffer(raw, dtype=np.uint32, count=1)[0])
+    kinds = raw[4:4 + len(_section_fields)]
+    offset = 4 + len(_section_fields)
+
+    stored = {}
+    for (field, dtype, scale), kind in zip(_section_fields, kinds):
+        dtype = np.float64 if kind == _column_float else dtype
+        stored[field] = _unshuffle(raw, dtype, num_sections, offset)
+        offset += num_sections * np.dtype(dtype).itemsize
+
+    if kinds[0] == _column_gaps:
+        duration = stored["duration"].astype(np.int64)
+        stored["start"] = np.cumsum(stored["start"] + np.concatenate([[0], duration[:-1]]).astype(np.int64))
+
+    columns = {}
+    for (field, _, scale), kind in zip(_section_fields, kinds):
+        if kind == _column_float:
+            columns[field] = stored[field].tolist()
+        elif scale == 1:
+            columns[field] = stored[field].astype(np.int64).tolist()
+        else:
+            columns[field] = (stored[field].astype(np.int64) / scale).tolist()
+
+    return [{field: columns[field][i] for field, _, _ in _section_fields} for i in range(num_sections)]
+
+
+def get_track_sections(item):
+    if "sections_encoded" in item:
+        return decode_sections(item["sections_encoded"])
+    return item.get("raw_sections", [])
+
+
+class ResponseCache:
+    """On-disk cache for Spotify responses, keyed by endpoint and item id, with size-based LRU eviction.
+
+    Responses that can change (e.g. artists) are read with max_age, so stale entries count as misses. Hits only
+    record their access time in memory; it is written in batches, before eviction and on close.
+    """
+
+    def __init__(self, path=response_cache_path, max_bytes=2 * 1024 ** 3, compress=True, access_batch_size=1000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        self.access_batch_size = access_batch_size
+        self._pending_access = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                value BLOB NOT NULL,
+                compressed INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                stored_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (endpoint, item_id)
+            )
+        """)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(responses)")]
+        if "stored_at" not in columns:  # caches created before max_age support
+            self._connection.execute("ALTER TABLE responses ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, endpoint, item_id, max_age=None):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, compressed, stored_at FROM responses WHERE endpoint = ? AND item_id = ?",
+                (endpoint, item_id)
+            ).fetchone()
+            if row is None or (max_age is not None and row[2] < time.time() - max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pending_access[(endpoint, item_id)] = time.time()
+            if len(self._pending_access) >= self.access_batch_size:
+                self._flush_access()
+                self._connection.commit()
+
+        value, compressed, _ = row
+        if compressed:
+            value = zlib.decompress(value)
+        return json.loads(value)
+
+    def put(self, endpoint, item_id, response):
+        value = json.dumps(response, separators=(",", ":")).encode()
+        if self.compress:
+            value = zlib.compress(value)
+
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM responses WHERE endpoint = ? AND item_id = ?", (endpoint, item_id)
+            ).fetchone()
+            self._size -= previous[0] if previous else 0
+            now = time.time()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (endpoint, item_id, value, compressed, size, last_access, stored_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, item_id, value, int(self.compress), len(value), now, now)
+            )
+            self._size += len(value)
+            self._evict()
+            self._connection.commit()
+
+    def _flush_access(self):
+        if self._pending_access:
+            self._connection.executemany(
+                "UPDATE responses SET last_access = ? WHERE endpoint = ? AND item_id = ?",
+                [(last_access, endpoint, item_id) for (endpoint, item_id), last_access in self._pending_access.items()]
+            )
+            self._pending_access.clear()
+
+    def _evict(self):
+        if self._size > self.max_bytes:
+            self._flush_access()
+        while self._size > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT endpoint, item_id, size FROM responses ORDER BY last_access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for endpoint, item_id, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                self._connection.execute(
+                    "DELETE FROM responses WHERE endpoint = ? AND item_id = ?", (endpoint, item_id)
+                )
+                self._size -= size
+
+    def get_or_fetch(self, endpoint, item_id, fetch):
+        response = self.get(endpoint, item_id)
+        if response is None:
+            response = fetch()
+            if response is not None:
+                self.put(endpoint, item_id, response)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._flush_access()
+            self._connection.commit()
+            self._connection.close()
+
+
+class RateLimiter:
+    """Token bucket with AIMD rate and concurrency, shared by every Spotify client in the process.
+
+    Until the first 429 the rate roughly doubles every second (slow start). Each 429 halves the rate and the
+    concurrency limit and pauses all callers for Retry-After seconds; after that, successful calls grow both back
+    additively.
+    """
+
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=100.0, concurrency=8, max_concurrency=32, increase=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.throttles = 0
+        self._slow_start = True
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    timeout = self._blocked_until - now
+                elif self._in_flight >= int(self.concurrency):
+                    timeout = None  # woken up by release
+                elif self._tokens < 1:
+                    timeout = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                self._condition.wait(timeout=timeout)
+
+    def release(self, success=True, retry_after=None):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if retry_after is not None:
+                self.throttles += 1
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+                self._tokens = 0.0
+                # Requests already in flight when the limit was hit should not cut the rate again
+                self._slow_start = False
+                if now - self._last_decrease > retry_after:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self._last_decrease = now
+            elif success:
+                step = 1.0 if self._slow_start else self.increase / self.rate
+                self.rate = min(self.max_rate, self.rate + step)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+
+spotify_rate_limiter = RateLimiter()
+user_max_rate = 20.0  # per-user share of the app-wide budget in multi-user runs
+_user_rate_limiters = {}
 
-    sp_oauth = SpotifyOAuth(client_id, client_secret, redirect_uri, scope=scope, cache_path=cache_path)
-    token_info = sp_oauth.refresh_access_token(refresh_token)
 
-    sp = spotipy.Spotify(auth=token_info["access_token"], requests_timeout=25, retries=10)
+def get_user_rate_limiter(user_id):
+    with _client_cache_lock:
+        if user_id not in _user_rate_limiters:
+            _user_rate_limiters[user_id] = RateLimiter(rate=min(10.0, user_max_rate), max_rate=user_max_rate)
+        return _user_rate_limiters[user_id]
+
+
+class RateLimitedSpotify:
+    """Wraps a spotipy client so every API call goes through its RateLimiters and 429s are retried after Retry-After."""
+
+    def __init__(self, client, limiters=(spotify_rate_limiter,), max_retries=10):
+        self._client = client
+        self._limiters = limiters
+        self._max_retries = max_retries
+
+    def _acquire(self):
+        for limiter in self._limiters:
+            limiter.acquire()
+
+    def _release(self, **kwargs):
+        for limiter in self._limiters:
+            limiter.release(**kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+
+        def call(*args, **kwargs):
+            for attempt in range(self._max_retries + 1):
+                self._acquire()
+                try:
+                    response = attribute(*args, **kwargs)
+                except spotipy.SpotifyException as e:
+                    if e.http_status != 429 or attempt == self._max_retries:
+                        self._release(success=False)
+                        raise
+                    retry_after = float((e.headers or {}).get("Retry-After", 1))
+                    self._release(success=False, retry_after=retry_after)
+                    metrics.add(metrics.current_stage() or f"spotify.{name}", retries=1)
+                    continue
+                except Exception:
+                    self._release(success=False)
+                    raise
+                self._release()
+                return response
+
+        return call
+
+
+def build_requests_session(retries=10, status_forcelist=(500, 502, 503, 504), backoff_factor=0.3):
+    # Like spotipy's own session, but urllib3 must not honour Retry-After: it would retry 429s itself, sleeping in
+    # the calling thread, and spotipy would raise without the headers. Only server errors are retried here.
+    retry = Retry(total=retries, connect=None, read=False, status=retries, backoff_factor=backoff_factor,
+                  allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]), status_forcelist=status_forcelist,
+                  respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def new_spotify_client(access_token, limiters=(spotify_rate_limiter,), prefix=None):
+    # 429s are left to RateLimitedSpotify so the backoff is shared between threads
+    sp = spotipy.Spotify(auth=access_token, requests_session=build_requests_session(), requests_timeout=25)
+    if prefix is not None:  # API base URL, e.g. a local server
+        sp.prefix = prefix
+    return metrics.InstrumentedSpotify(RateLimitedSpotify(sp, limiters=limiters))
+
+
+def _cached_client(key):
+    cached = _client_cache.get(key)
+    if cached is not None and cached["expires_at"] - _token_expiry_margin > time.time():
+        return cached["client"]
+    return None
+
+
+@metrics.instrumented("get_spotipy_client")
+def get_spotipy_client(scope, user_id=None):
+    limiters = (spotify_rate_limiter,) if user_id is None else (get_user_rate_limiter(user_id), spotify_rate_limiter)
+    key = (scope, user_id)
+
+    with _client_cache_lock:
+        sp = _cached_client(key)
+        if sp is not None:
+            client_cache_stats["hits"] += 1
+            return sp
+        client_lock = _client_locks.setdefault(key, threading.Lock())
+
+    # The token refresh only holds this (scope, user) lock, so other users' cache hits and refreshes are not blocked
+    with client_lock:
+        with _client_cache_lock:
+            sp = _cached_client(key)  # refreshed by another thread while this one waited
+        if sp is not None:
+            with _client_cache_lock:
+                client_cache_stats["hits"] += 1
+            return sp
+
+        client_secret, client_id, refresh_token = get_ssm_parameters(
+            ["SPOTIFY_CLIENT_SECRET", "SPOTIFY_CLIENT_ID", refresh_token_parameter(scope, user_id)]
+        )
+
+        sp_oauth = SpotifyOAuth(client_id, client_secret, redirect_uri, scope=scope, cache_path=cache_path)
+        token_info = sp_oauth.refresh_access_token(refresh_token)
+
+        sp = new_spotify_client(token_info["access_token"], limiters=limiters)
+        with _client_cache_lock:
+            client_cache_stats["misses"] += 1
+            _client_cache[key] = {"client": sp, "expires_at": token_info["expires_at"]}
 
     return sp
 
 
-def read_full_dynamo_table(table_name):
-    session = boto3.Session(profile_name="default")
-    dynamodb = session.resource("dynamodb", region_name="eu-west-1")
-    table = dynamodb.Table(table_name)
-    response = table.scan()
-    data = response["Items"]
+def _response_size(response):
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    return int(headers.get("content-length", 0))
 
-    # Handle pagination
-    while "LastEvaluatedKey" in response:
-        response = table.scan(ExclusiveStartKey=response["LastEvaluatedKey"])
-        data.extend(response["Items"])
 
-    return data
+def scan_dynamo_table(table_name, attributes=None, segments=4):
+    scan_kwargs = {"TotalSegments": segments}
+    if attributes:
+        names = {f"#a{i}": attribute for i, attribute in enumerate(attributes)}
+        scan_kwargs["ProjectionExpression"] = ", ".join(names)
+        scan_kwargs["ExpressionAttributeNames"] = names
 
+    pages = queue.Queue(maxsize=segments * 2)  # bounds how far segments can run ahead of the consumer
+    stop = threading.Event()
+    segment_done = object()
+
+    def put(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        try:
+            # boto3 resources are not thread safe, so each segment gets its own
+            table = get_dynamo_table(table_name)
+            kwargs = {**scan_kwargs, "Segment": segment}
+            while not stop.is_set():
+                with metrics.timed("dynamodb.scan"):
+                    response = table.scan(**kwargs)
+                metrics.add("dynamodb.scan", items=len(response["Items"]), size=_response_size(response))
+                put(response["Items"])
+                if "LastEvaluatedKey" not in response:
+                    break
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except Exception as e:
+            put(e)
+        finally:
+            put(segment_done)
+
+    executor = ThreadPoolExecutor(max_workers=segments)
+    for segment in range(segments):
+        executor.submit(scan_segment, segment)
+
+    try:
+        remaining = segments
+        while remaining:
+            page = pages.get()
+            if page is segment_done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def query_dynamo_index(table, index_name, key, value):
+    kwargs = {"IndexName": index_name, "KeyConditionExpression": Key(key).eq(value)}
+    while True:
+        with metrics.timed("dynamodb.query"):
+            response = table.query(**kwargs)
+        metrics.add("dynamodb.query", items=len(response["Items"]), size=_response_size(response))
+        yield from response["Items"]
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+@metrics.instrumented("read_full_dynamo_table")
+def read_full_dynamo_table(table_name, attributes=None, segments=1):
+    return list(scan_dynamo_table(table_name, attributes=attributes, segments=segments))
 
-def load_to_dynamo(data, table_name, empty_table=False):
-    session = boto3.Session(profile_name=profile)
 
+def get_dynamo_table(table_name):
+    session = boto3.Session(profile_name=profile)
     dynamodb = session.resource("dynamodb", region_name="eu-west-1")
-    table = dynamodb.Table(table_name)
+
+    return dynamodb.Table(table_name)
+
+
+def get_watermark(name):
+    table = get_dynamo_table(state_table_name)
+    response = table.get_item(Key={"name": name})
+
+    return response.get("Item", {}).get("value")
+
+
+def set_watermark(name, value):
+    table = get_dynamo_table(state_table_name)
+    table.put_item(Item={"name": name, "value": value})
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@metrics.instrumented("load_to_dynamo")
+def load_to_dynamo(data, table_name, empty_table=False, workers=1):
+    table = get_dynamo_table(table_name)
     keys = [k["AttributeName"] for k in table.key_schema]
 
     if empty_table:
         empty_dynamo_table(table, keys)
 
-    with table.batch_writer() as batch:
+    if workers > 1:
+        summary = bulk_write_to_dynamo(data, table_name, keys, workers=workers)
+    else:
+        start_t = time.perf_counter()
+        summary = {"items": 0}
+        with table.batch_writer() as batch:
+            for item in data:
+                batch.put_item(Item=item)
+                summary["items"] += 1
+                metrics.add("load_to_dynamo", items=1, size=metrics.item_size(item))
+        summary["seconds"] = round(time.perf_counter() - start_t, 3)
+
+    return summary
+
+
+def get_write_executor(workers):
+    # One pool per size for the whole run, so its threads (and their DynamoDB resources) are reused across calls
+    with _write_executors_lock:
+        if workers not in _write_executors:
+            _write_executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dynamo-writer")
+        return _write_executors[workers]
+
+
+def _writer_dynamodb():
+    if not hasattr(_writer_local, "dynamodb"):  # boto3 resources are not thread safe
+        _writer_local.dynamodb = boto3.Session(profile_name=profile).resource("dynamodb", region_name="eu-west-1")
+    return _writer_local.dynamodb
+
+
+def bulk_write_to_dynamo(data, table_name, keys, workers=4, max_retries=10):
+    # Items are sharded into 25-item BatchWriteItem requests spread over the worker threads. Unprocessed items and
+    # throttling errors are retried explicitly (with exponential backoff) so they can be counted.
+    summary = {"items": 0, "requests": 0, "unprocessed_retries": 0, "throttles": 0}
+    summary_lock = threading.Lock()
+
+    def count(**values):
+        with summary_lock:
+            for k, v in values.items():
+                summary[k] += v
+
+    def write_chunk(chunk):
+        dynamodb = _writer_dynamodb()
+
+        # BatchWriteItem rejects duplicated keys in one request, the last version of an item wins
+        unique = {tuple(item[k] for k in keys): item for item in chunk}
+        requests = [{"PutRequest": {"Item": item}} for item in unique.values()]
+        for attempt in range(max_retries + 1):
+            try:
+                count(requests=1)
+                response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in _throttling_errors or attempt == max_retries:
+                    raise
+                count(throttles=1)
+                metrics.add("load_to_dynamo", retries=1)
+            else:
+                requests = response.get("UnprocessedItems", {}).get(table_name, [])
+                if not requests:
+                    break
+                count(unprocessed_retries=len(requests))
+                metrics.add("load_to_dynamo", retries=1)
+            time.sleep(min(0.05 * 2 ** attempt, 5) * (0.5 + np.random.random() / 2))
+        else:
+            raise RuntimeError(f"{len(requests)} items still unprocessed after {max_retries} retries")
+
+        count(items=len(unique))
+        metrics.add("load_to_dynamo", items=len(unique), size=sum(metrics.item_size(item) for item in unique.values()))
+
+    start_t = time.perf_counter()
+    executor = get_write_executor(workers)
+    # At most two chunks per worker are in flight, so a large generator is never read far ahead of the writes
+    pending = set()
+    try:
+        for chunk in batched(data, 25):
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(write_chunk, chunk))
+        for future in pending:
+            future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+    elapsed = time.perf_counter() - start_t
+    summary["seconds"] = round(elapsed, 3)
+    summary["items_per_s"] = round(summary["items"] / elapsed, 1) if elapsed > 0 else 0.0
+    logging.info(f"{table_name}: {summary}")
+
+    return summary
+
+
+@metrics.instrumented("sync_dynamo_table")
+def sync_dynamo_table(data, table_name, user_id=None):
+    # Only rows that are new or changed are written, and only rows no longer present are deleted.
+    # In multi-user runs only that user's rows are read, through the user_id index, so each user's diff does not
+    # grow with the other users' rows.
+    table = get_dynamo_table(table_name)
+    keys = [k["AttributeName"] for k in table.key_schema]
+    if user_id is not None:
+        existing = query_dynamo_index(table, user_index_name, "user_id", user_id)
+    else:
+        existing = (item for item in scan_dynamo_table(table_name) if "user_id" not in item)
+    current = {tuple(item[key] for key in keys): item for item in existing}
+
+    changes = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    with table.batch_writer(overwrite_by_pkeys=keys) as batch:
         for item in data:
+            key = tuple(item[k] for k in keys)
+            existing = current.pop(key, None)
+            if existing == item:
+                changes["unchanged"] += 1
+                continue
+            changes["inserted" if existing is None else "updated"] += 1
             batch.put_item(Item=item)
+            metrics.add("sync_dynamo_table", items=1, size=metrics.item_size(item))
+        for key in current:
+            changes["deleted"] += 1
+            batch.delete_item(Key=dict(zip(keys, key)))
+
+    logging.info(f"{table_name}: {changes}")
+    return changes
 
 
 def empty_dynamo_table(table, keys=None):
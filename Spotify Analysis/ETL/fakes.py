@@ -0,0 +1,413 @@
+"""Local stand-ins for the Spotify API, SSM and DynamoDB, used to run the ETLs offline (see Benchmark.py)."""
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import spotipy
+
+import common
+from metrics import item_size
+
+default_key_schemas = {
+    "track_info": ["track_id"],
+    "top_artists": ["id"],
+    "saved_tracks": ["user_id", "track_id"],
+    "recently_played": ["played_date", "played_at"],
+    common.state_table_name: ["name"]
+}
+
+_genres = ["rock", "indie", "pop", "jazz", "techno", "house", "hip hop", "folk", "ambient", "metal"]
+
+
+class FakeSpotifyAPI:
+    def __init__(self, library_size=1000, recent_plays=500, latency=0.0, rate_limit=None, raise_on_limit=False,
+                 seed=0):
+        self.latency = latency
+        self.rate_limit = rate_limit  # requests per second, None for no limit
+        self.raise_on_limit = raise_on_limit
+        self.calls = Counter()
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0
+        self._last_refill = time.monotonic()
+
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        num_artists = max(library_size // 5, 1)
+        self.artists_by_id = {}
+        for i in range(num_artists):
+            artist_id = f"artist{i:07d}"
+            self.artists_by_id[artist_id] = {
+                "id": artist_id,
+                "name": f"Artist {i % max(num_artists - 10, 1)}",  # a few duplicated names, like real libraries
+                "genres": rng.sample(_genres, rng.randint(0, 3)),
+                "followers": {"total": rng.randint(0, 10 ** 6)},
+                "images": [{"url": f"https://img.local/{artist_id}"}],
+                "external_urls": {"spotify": f"https://open.spotify.local/artist/{artist_id}"}
+            }
+        artist_ids = list(self.artists_by_id)
+
+        self.saved_items = []
+        for i in range(library_size):
+            track_id = f"track{i:07d}"
+            artist = self.artists_by_id[rng.choice(artist_ids)]
+            track = {
+                "id": track_id,
+                "name": f"Track {i}",
+                "album": {"name": f"Album {i // 10}"},
+                "artists": [{"id": artist["id"], "name": artist["name"]}],
+                "duration_ms": rng.randint(90000, 420000),
+                "explicit": rng.random() < 0.1,
+                "popularity": rng.randint(0, 100),
+                "external_urls": {"spotify": f"https://open.spotify.local/track/{track_id}"}
+            }
+            added_at = now - timedelta(hours=i)
+            self.saved_items.append({"added_at": added_at.strftime("%Y-%m-%dT%H:%M:%SZ"), "track": track})
+        self.tracks_by_id = {item["track"]["id"]: item["track"] for item in self.saved_items}
+
+        self.plays = []
+        for i in range(recent_plays):
+            played_at = now - timedelta(minutes=3 * i)
+            self.plays.append({
+                "played_at": played_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "track": rng.choice(self.saved_items)["track"] if self.saved_items else None
+            })
+
+    def _request(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+            if self.rate_limit:
+                while True:
+                    elapsed = time.monotonic() - self._last_refill
+                    self._tokens = min(self.rate_limit, self._tokens + elapsed * self.rate_limit)
+                    self._last_refill = time.monotonic()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    self.throttled += 1
+                    retry_after = (1 - self._tokens) / self.rate_limit
+                    if self.raise_on_limit:
+                        raise spotipy.SpotifyException(429, -1, "API rate limit exceeded",
+                                                       headers={"Retry-After": str(max(int(retry_after + 0.5), 1))})
+                    time.sleep(retry_after)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def client(self, auth=None, requests_timeout=None, retries=None, **kwargs):
+        return FakeSpotify(self)
+
+
+class FakeSpotify:
+    def __init__(self, api):
+        self.api = api
+
+    def current_user_saved_tracks(self, limit=20, offset=0):
+        self.api._request("saved_tracks")
+        items = self.api.saved_items[offset:offset + limit]
+        total = len(self.api.saved_items)
+        return {"items": items, "total": total, "offset": offset, "limit": limit,
+                "next": f"offset={offset + limit}" if offset + limit < total else None}
+
+    def audio_analysis(self, track_id):
+        self.api._request("audio_analysis")
+        rng = random.Random(zlib.crc32(track_id.encode()))
+        sections = []
+        start = 0.0
+        for _ in range(rng.randint(6, 14)):
+            # Rounded like Spotify: times to 5 decimals, everything else to 3
+            duration = round(rng.uniform(8, 40), 5)
+            sections.append({
+                "start": start, "duration": duration, "confidence": round(rng.random(), 3),
+                "loudness": round(rng.uniform(-20, -2), 3), "tempo": rng.choice([90.0, 120.0, 124.0, 140.0]),
+                "tempo_confidence": round(rng.random(), 3), "key": rng.randint(-1, 11),
+                "key_confidence": round(rng.random(), 3), "mode": rng.randint(0, 1),
+                "mode_confidence": round(rng.random(), 3), "time_signature": rng.choice([3, 4]),
+                "time_signature_confidence": round(rng.random(), 3)
+            })
+            start = round(start + duration, 5)
+        return {"track": {"duration": start}, "sections": sections}
+
+    def audio_features(self, tracks):
+        self.api._request("audio_features")
+        results = []
+        for track_id in tracks:
+            rng = random.Random(zlib.crc32(track_id.encode()))
+            results.append({
+                "id": track_id, "danceability": rng.random(), "energy": rng.random(), "key": rng.randint(0, 11),
+                "loudness": rng.uniform(-20, -2), "mode": rng.randint(0, 1), "speechiness": rng.random(),
+                "acousticness": rng.random(), "instrumentalness": rng.random(), "liveness": rng.random(),
+                "valence": rng.random(), "tempo": rng.uniform(60, 180)
+            })
+        return results
+
+    def tracks(self, tracks):
+        self.api._request("tracks")
+        tracks_by_id = {item["track"]["id"]: item["track"] for item in self.api.saved_items}
+        return {"tracks": [tracks_by_id.get(track_id) for track_id in tracks]}
+
+    def artists(self, artists):
+        self.api._request("artists")
+        return {"artists": [self.api.artists_by_id[artist_id] for artist_id in artists]}
+
+    def current_user_top_artists(self, limit=20, offset=0, time_range="medium_term"):
+        self.api._request("top_artists")
+        ranges = {"short_term": 0, "medium_term": 1, "long_term": 2}
+        artists = list(self.api.artists_by_id.values())
+        start = offset + ranges[time_range] * 5
+        return {"items": artists[start:start + limit], "total": len(artists)}
+
+    def current_user_recently_played(self, limit=50, after=None, before=None):
+        self.api._request("recently_played")
+        plays = [p for p in self.api.plays if p["track"] is not None]
+
+        def to_ms(played_at):
+            return int(datetime.strptime(played_at, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp() * 1000)
+
+        if after is not None:
+            plays = [p for p in plays if to_ms(p["played_at"]) > int(after)][-limit:]
+        elif before is not None:
+            plays = [p for p in plays if to_ms(p["played_at"]) < int(before)][:limit]
+        else:
+            plays = plays[:limit]
+        cursors = {"after": str(to_ms(plays[0]["played_at"])), "before": str(to_ms(plays[-1]["played_at"]))} \
+            if plays else None
+        return {"items": plays, "cursors": cursors, "limit": limit}
+
+
+class FakeSpotifyHTTPServer:
+    """Local HTTP server answering with the given (status, headers, body) responses in turn, so a real spotipy client
+    (HTTP layer included) can be pointed at it: sp.prefix = server.prefix."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                status, headers, body = server.responses.pop(0) if server.responses else (200, {}, {})
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in {"Content-Type": "application/json", **headers}.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.prefix = f"http://127.0.0.1:{self._httpd.server_address[1]}/v1/"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class FakeSpotifyOAuth:
+    def __init__(self, client_id, client_secret, redirect_uri, scope=None, cache_path=None, **kwargs):
+        self.scope = scope
+
+    def refresh_access_token(self, refresh_token):
+        return {"access_token": f"token-{refresh_token}", "expires_at": int(time.time()) + 3600}
+
+
+class FakeSSM:
+    def __init__(self, parameters=None):
+        self.parameters = parameters or {}
+        self.calls = Counter()
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.calls["get_parameter"] += 1
+        return {"Parameter": {"Name": Name, "Value": self.parameters.get(Name, f"fake-{Name}")}}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.calls["get_parameters"] += 1
+        return {
+            "Parameters": [{"Name": n, "Value": self.parameters.get(n, f"fake-{n}")} for n in Names],
+            "InvalidParameters": []
+        }
+
+
+class FakeDynamoDB:
+    def __init__(self, key_schemas=None, page_size=100, unprocessed_rate=0.0, seed=0):
+        self.key_schemas = {**default_key_schemas, **(key_schemas or {})}
+        self.page_size = page_size
+        self.unprocessed_rate = unprocessed_rate  # share of BatchWriteItem requests returned as unprocessed
+        self._rng = random.Random(seed)
+        self.tables = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def Table(self, table_name):
+        if table_name not in self.tables:
+            self.tables[table_name] = FakeTable(self, table_name, self.key_schemas.get(table_name, ["id"]))
+        return self.tables[table_name]
+
+
+    def batch_write_item(self, RequestItems):
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            table._count("write_requests")
+            for request in requests:
+                with self._lock:
+                    skip = self._rng.random() < self.unprocessed_rate
+                if skip:
+                    unprocessed.setdefault(table_name, []).append(request)
+                elif "PutRequest" in request:
+                    table._write(dict(request["PutRequest"]["Item"]))
+                else:
+                    table._delete(request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": unprocessed}
+
+
+class FakeTable:
+    def __init__(self, db, name, keys):
+        self.db = db
+        self.name = name
+        self.keys = keys
+        self.key_schema = [{"AttributeName": key, "KeyType": "HASH" if i == 0 else "RANGE"}
+                           for i, key in enumerate(keys)]
+        self.items = {}
+
+    def _key(self, item):
+        return tuple(item[key] for key in self.keys)
+
+    def _count(self, stat, value=1):
+        with self.db._lock:
+            self.db.stats[stat] += value
+
+    def _write(self, item):
+        size = item_size(item)
+        self._count("items_written")
+        self._count("bytes_written", size)
+        self._count("write_units", -(-size // 1024))
+        with self.db._lock:
+            self.items[self._key(item)] = item
+
+    def _delete(self, key):
+        self._count("items_deleted")
+        self._count("write_units")
+        with self.db._lock:
+            self.items.pop(self._key(key), None)
+
+    def put_item(self, Item, **kwargs):
+        self._count("write_requests")
+        self._write(dict(Item))
+
+    def get_item(self, Key, **kwargs):
+        self._count("read_requests")
+        item = self.items.get(self._key(Key))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def delete_item(self, Key, **kwargs):
+        self._count("write_requests")
+        self._delete(Key)
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, **kwargs):
+        self._count("read_requests")
+        with self.db._lock:
+            items = sorted((k, v) for k, v in self.items.items()
+                           if zlib.crc32(repr(k).encode()) % TotalSegments == Segment)
+        start = 0
+        if ExclusiveStartKey is not None:
+            last = self._key(ExclusiveStartKey)
+            start = next((i for i, (k, _) in enumerate(items) if k > last), len(items))
+        page = [v for _, v in items[start:start + self.db.page_size]]
+
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            attributes = [names.get(a.strip(), a.strip()) for a in ProjectionExpression.split(",")]
+            page = [{a: item[a] for a in attributes if a in item} for item in page]
+        else:
+            page = [dict(item) for item in page]
+        self._count("items_read", len(page))
+        self._count("bytes_read", sum(item_size(item) for item in page))
+
+        response = {"Items": page}
+        if start + self.db.page_size < len(items):
+            response["LastEvaluatedKey"] = dict(zip(self.keys, items[start + self.db.page_size - 1][0]))
+        return response
+
+    def query(self, IndexName=None, KeyConditionExpression=None, ExclusiveStartKey=None, **kwargs):
+        # Only equality on a single (index) partition key, which is all the ETLs use
+        self._count("read_requests")
+        expression = KeyConditionExpression.get_expression()
+        name, value = expression["values"][0].name, expression["values"][1]
+        with self.db._lock:
+            items = sorted((k, v) for k, v in self.items.items() if v.get(name) == value)
+        start = 0
+        if ExclusiveStartKey is not None:
+            last = self._key(ExclusiveStartKey)
+            start = next((i for i, (k, _) in enumerate(items) if k > last), len(items))
+        page = [dict(v) for _, v in items[start:start + self.db.page_size]]
+        self._count("items_read", len(page))
+        self._count("bytes_read", sum(item_size(item) for item in page))
+
+        response = {"Items": page}
+        if start + self.db.page_size < len(items):
+            response["LastEvaluatedKey"] = dict(zip(self.keys, items[start + self.db.page_size - 1][0]))
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+
+class FakeBatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.table._count("write_requests")
+            self.pending = 0
+
+    def _add(self):
+        self.pending += 1
+        if self.pending == 25:
+            self._flush()
+
+    def put_item(self, Item):
+        self.table._write(dict(Item))
+        self._add()
+
+    def delete_item(self, Key):
+        self.table._delete(Key)
+        self._add()
+
+
+def install(api=None, ssm=None, dynamodb=None):
+    """Point common.py at the local stand-ins. Returns the (api, ssm, dynamodb) objects in use."""
+    api = api or FakeSpotifyAPI()
+    ssm = ssm or FakeSSM()
+    dynamodb = dynamodb or FakeDynamoDB()
+
+    common.boto3 = SimpleNamespace(
+        client=lambda service, **kwargs: ssm,
+        Session=lambda **kwargs: SimpleNamespace(resource=lambda service, **kw: dynamodb)
+    )
+    common.spotipy = SimpleNamespace(Spotify=api.client, SpotifyException=spotipy.SpotifyException)
+    common.SpotifyOAuth = FakeSpotifyOAuth
+    common._client_cache.clear()
+    common._secrets_cache.clear()
+    common._writer_local = threading.local()  # writer threads outlive a run, drop their cached resources
+
+    return api, ssm, dynamodb
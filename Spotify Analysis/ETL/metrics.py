@@ -0,0 +1,164 @@
+"""Per-stage call counts, latency histograms, retries, items and bytes for the Spotify ETLs."""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from decimal import Decimal
+
+metrics_path = os.path.join(tempfile.gettempdir(), "spotify_etl_metrics")
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_lock = threading.Lock()
+_stages = {}
+_current = threading.local()
+
+
+def _new_stage():
+    return {
+        "calls": 0, "errors": 0, "retries": 0, "items": 0, "bytes": 0,
+        "latency_total_s": 0.0, "latency_max_s": 0.0,
+        "latency_histogram": {str(b): 0 for b in latency_buckets + ["inf"]}
+    }
+
+
+def item_size(value):
+    # Rough DynamoDB item size: attribute names plus value sizes
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode()) + item_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(item_size(v) + 1 for v in value)
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if hasattr(value, "value") and isinstance(value.value, bytes):  # boto3 Binary
+        return len(value.value)
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return len(str(value)) // 2 + 1
+    return 1
+
+
+def record(stage, seconds=None, items=0, size=0, retries=0, error=False, calls=1):
+    with _lock:
+        s = _stages.setdefault(stage, _new_stage())
+        s["calls"] += calls
+        s["items"] += items
+        s["bytes"] += size
+        s["retries"] += retries
+        s["errors"] += int(error)
+        if seconds is not None:
+            s["latency_total_s"] += seconds
+            s["latency_max_s"] = max(s["latency_max_s"], seconds)
+            bucket = next((b for b in latency_buckets if seconds <= b), "inf")
+            s["latency_histogram"][str(bucket)] += 1
+
+
+def add(stage, items=0, size=0, retries=0):
+    record(stage, items=items, size=size, retries=retries, calls=0)
+
+
+def current_stage():
+    return getattr(_current, "stage", None)
+
+
+@contextmanager
+def timed(stage):
+    previous = current_stage()
+    _current.stage = stage
+    start_t = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        record(stage, time.perf_counter() - start_t, error=error)
+        _current.stage = previous
+
+
+def instrumented(stage):
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def count_items(response):
+    if isinstance(response, dict):
+        for key in ("items", "artists", "sections", "tracks"):
+            if isinstance(response.get(key), list):
+                return len(response[key])
+        return 1
+    if isinstance(response, list):
+        return len(response)
+    return 0
+
+
+class InstrumentedSpotify:
+    """Wraps a spotipy client so every API method is recorded as a "spotify.<method>" stage."""
+
+    def __init__(self, client):
+        self._client = client
+        session = getattr(client, "_session", None)
+        if session is not None:
+            session.hooks["response"].append(self._on_response)
+
+    @staticmethod
+    def _on_response(response, *args, **kwargs):
+        stage = current_stage()
+        if stage is not None:
+            retry = getattr(getattr(response, "raw", None), "retries", None)
+            retries = len(retry.history) if retry is not None and getattr(retry, "history", None) else 0
+            add(stage, size=len(response.content or b""), retries=retries)
+        return response
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+
+        def call(*args, **kwargs):
+            stage = f"spotify.{name}"
+            with timed(stage):
+                response = attribute(*args, **kwargs)
+            add(stage, items=count_items(response))
+            return response
+
+        return call
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def report():
+    with _lock:
+        stages = json.loads(json.dumps(_stages))
+    for s in stages.values():
+        s["latency_avg_s"] = s["latency_total_s"] / s["calls"] if s["calls"] else 0.0
+
+    return {"generated_at": datetime.now(timezone.utc).isoformat(), "stages": stages}
+
+
+def write_report(name, directory=metrics_path):
+    data = {"script": name, **report()}
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}_metrics.json")
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+    summary = ", ".join(f"{stage}: {s['calls']} calls/{s['latency_total_s']:.1f}s"
+                        for stage, s in sorted(data["stages"].items()))
+    logging.info(f"Metrics written to {path} ({summary})")
+
+    return path